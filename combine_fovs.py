@@ -7,19 +7,37 @@ import sys
 directory = '/mnt/cephalotus_4/chris/store/'
 
 in_filename_list = ['max_round3_gtac.ome.tif', 'max_round3_gtac_238toend.ome.tif']
-fov_ranges = [np.arange(0, 238), np.arange(238, 2515)]
+fov_ranges = [range(0, 238), range(238, 2515)]  # Consecutive FOV ranges, in output order; read as contiguous page slices
 # in_filename_list = ['max_round6_gtac.ome.tif']
 
+chunk_size = 64  # Number of FOVs held in memory at a time
+
+# The FOVs are streamed in order, so each range has to start where the previous one stops
+for previous_range, fov_range in zip(fov_ranges, fov_ranges[1:]):
+    if fov_range.start != previous_range.stop:
+        raise ValueError(f"FOV ranges must be consecutive: {previous_range} is followed by {fov_range}")
+
+# Yield the (C, Y, X) FOVs of each input file in output order, reading chunk_size FOVs at a time
+def iter_fovs():
+    for fov_range, in_filename in zip(fov_ranges, in_filename_list):
+        with tifffile.TiffFile(directory + in_filename) as tf:
+            print(tf.series[0].shape)
+            channels = tf.series[0].shape[1]
+            for start in range(0, len(fov_range), chunk_size):
+                end = min(start + chunk_size, len(fov_range))
+                frames = tf.asarray(key=slice(start * channels, end * channels))  # One YX page per FOV and channel
+                yield from frames.reshape((end - start, channels) + frames.shape[-2:])
+
 start_processing = time.time()
-full_round_image = np.zeros((2515, 4, 2304, 2304), dtype=np.uint16)
 
-for fov_range, in_filename in zip(fov_ranges, in_filename_list):
-    frames = tifffile.imread(directory + in_filename)
-    print(frames.shape)
-    
-    full_round_image[fov_range,:,:,:] = frames[fov_range - fov_range[0],:,:,:]
+# Take the output (C, Y, X) from the first input file
+with tifffile.TiffFile(directory + in_filename_list[0]) as tf:
+    fov_shape = tf.series[0].shape[1:]
+total_fovs = sum(len(fov_range) for fov_range in fov_ranges)
 
-tifffile.imwrite(directory + 'round3.ome.tif', full_round_image, ome=True, photometric='minisblack', metadata={'axes': 'TCYX'})
+# Stream the FOVs straight into the combined OME-TIFF instead of assembling the whole round in memory
+with tifffile.TiffWriter(directory + 'round3.ome.tif', bigtiff=True, ome=True) as tw:
+    tw.write(iter_fovs(), shape=(total_fovs,) + fov_shape, dtype=np.uint16, photometric='minisblack', metadata={'axes': 'TCYX'})
 
 total_duration = time.time() - start_processing
-print(f"Total time: {total_duration:.2f} seconds")
\ No newline at end of file
+print(f"Total time: {total_duration:.2f} seconds")
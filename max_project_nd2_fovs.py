@@ -1,11 +1,40 @@
-from tifffile import imwrite
+from tifffile import imwrite, memmap
 import numpy as np
 import pims
 import time
 import sys
+import os
+import queue
+import threading
+from projection import maxproj_z, channel_display_range, scale_to_uint8
+
+# Read FOVs on a background thread so decoding the next FOV overlaps with projecting the current one.
+# Puts (m, fov_data) for each FOV, then (None, None) when done, or (None, exception) if reading fails.
+def read_fovs(images, fovs, fov_queue):
+    try:
+        for m in range(fovs):
+            fov_queue.put((m, np.ascontiguousarray(images[m])))  # Load single FOV as a C-contiguous (C, Z, Y, X) block
+    except Exception as e:
+        fov_queue.put((None, e))
+    else:
+        fov_queue.put((None, None))
+
+# Lossless TIFF compressions accepted for the output, and which of them take a compression level (set to 1 for write speed)
+COMPRESSIONS = {'zstd', 'zlib', 'deflate', 'adobe_deflate', 'lzma', 'lzw', 'packbits'}
+LEVEL_COMPRESSIONS = {'zstd', 'zlib', 'deflate', 'adobe_deflate', 'lzma'}
 
 # Main function with input and output filenames as arguments
-def main(in_filename, out_filename, num_fovs=None):
+# compression, e.g. 'zstd' or 'zlib', writes a tiled, compressed OME-TIFF instead of an uncompressed one.
+# out_dtype=np.uint8 scales every FOV to 8 bits using the per-channel 1-99.5 percentile range of the first FOV.
+def main(in_filename, out_filename, num_fovs=None, compression=None, out_dtype=np.uint16):
+    # Check the compression before any FOV is processed
+    if compression and compression.lower() not in COMPRESSIONS:
+        raise ValueError(f"compression must be one of {sorted(COMPRESSIONS)}, got {compression!r}")
+
+    # Only 16-bit output or 8-bit display-scaled output are supported; check before the output file is created
+    if np.dtype(out_dtype) not in (np.uint16, np.uint8):
+        raise ValueError(f"out_dtype must be uint16 or uint8, got {np.dtype(out_dtype)}")
+
     # Start total duration timer
     start_total = time.time()
 
@@ -32,18 +61,38 @@ def main(in_filename, out_filename, num_fovs=None):
         duration_reading = time.time() - start_reading
         print(f"Time to read dimensions: {duration_reading:.2f} seconds")
 
-        # Preallocate the results array to hold the selected FOVs: shape (fovs, channels, height, width)
-        all_fovs_array = np.zeros((fovs, channels, height, width), dtype=np.uint16)
+        # Preallocate the results array as a memory-mapped OME-TIFF, so each FOV is stored straight into the output file: shape (fovs, channels, height, width)
+        # A compressed output can't be memory-mapped, so project into an uncompressed scratch file next to it instead
+        memmap_filename = out_filename + '.tmp.ome.tif' if compression else out_filename
+        all_fovs_array = memmap(memmap_filename, shape=(fovs, channels, height, width), dtype=out_dtype, ome=True, photometric='minisblack', metadata={'axes': 'TCYX'})
 
         # Start timer for processing FOVs
         start_processing = time.time()
 
-        # Process each FOV individually and store results directly in all_fovs_array
+        # Process each FOV individually and store results directly in all_fovs_array.
+        # A reader thread stays up to two FOVs ahead; the queue bound caps memory at a few FOVs.
+        fov_queue = queue.Queue(maxsize=2)
+        reader = threading.Thread(target=read_fovs, args=(images, fovs, fov_queue), daemon=True)
+        reader.start()
+        quantize = np.dtype(out_dtype) == np.uint8
+        if quantize:
+            max_proj = np.empty((channels, height, width), dtype=np.uint16)  # uint16 projection, reused for every FOV
+            p_lo = p_hi = None
         count = 0
         start_batch = time.time()
-        for m in range(fovs):
-            fov_data = images[m]  # Load single FOV
-            all_fovs_array[m] = np.max(fov_data, axis=1)  # Max project across Z and store directly in the output array
+        while True:
+            m, fov_data = fov_queue.get()
+            if m is None:
+                if fov_data is not None:
+                    raise fov_data
+                break
+            if quantize:
+                maxproj_z(fov_data, max_proj)
+                if p_lo is None:
+                    p_lo, p_hi = channel_display_range(max_proj)
+                scale_to_uint8(max_proj, p_lo, p_hi, all_fovs_array[m])
+            else:
+                maxproj_z(fov_data, all_fovs_array[m])  # Max project across Z straight into the output array, no temporary
             if count > 8:
                 duration_batch = time.time() - start_batch
                 print(f"Time per 10 FOVs to FOV {m}: {duration_batch:.2f} seconds")
@@ -51,6 +100,7 @@ def main(in_filename, out_filename, num_fovs=None):
                 count = 0
             else:
                 count += 1
+        reader.join()
 
         # Stop timer for processing FOVs
         duration_processing = time.time() - start_processing
@@ -59,8 +109,25 @@ def main(in_filename, out_filename, num_fovs=None):
     # Start timer for writing TIFF
     start_writing = time.time()
 
-    # Open TIFF writer with OME-TIFF format
-    imwrite(out_filename, all_fovs_array, ome=True, photometric='minisblack', metadata={'axes': 'TCYX'})
+    if compression:
+        # Write the tiled, compressed OME-TIFF, compressing tiles in parallel across CPU cores, then remove the scratch file.
+        # A failed write leaves neither the scratch file nor a partial output behind.
+        compressionargs = {'level': 1} if compression.lower() in LEVEL_COMPRESSIONS else None
+        try:
+            imwrite(out_filename, all_fovs_array, ome=True, photometric='minisblack', metadata={'axes': 'TCYX'},
+                    tile=(1024, 1024), compression=compression, compressionargs=compressionargs, maxworkers=os.cpu_count(),
+                    bigtiff=(all_fovs_array.nbytes > 2**31))
+        except BaseException:
+            if os.path.exists(out_filename):
+                os.remove(out_filename)
+            raise
+        finally:
+            del all_fovs_array
+            os.remove(memmap_filename)
+    else:
+        # Flush the memory-mapped OME-TIFF to disk
+        all_fovs_array.flush()
+        del all_fovs_array
 
     # Stop timer for writing TIFF
     duration_writing = time.time() - start_writing
@@ -75,4 +142,6 @@ if __name__ == "__main__":
     in_filename = sys.argv[1] if len(sys.argv) > 1 else '/path/image.nd2'
     out_filename = sys.argv[2] if len(sys.argv) > 2 else '/path/max_image.ome.tif'
     num_fovs = int(sys.argv[3]) if len(sys.argv) > 3 else None  # Optional number of FOVs to process
-    main(in_filename, out_filename, num_fovs)
+    compression = sys.argv[4] if len(sys.argv) > 4 and sys.argv[4] != 'none' else None  # Optional compression, e.g. zstd, or none
+    out_dtype = np.dtype(sys.argv[5]) if len(sys.argv) > 5 else np.uint16  # Optional output dtype, uint16 or uint8
+    main(in_filename, out_filename, num_fovs, compression, out_dtype)
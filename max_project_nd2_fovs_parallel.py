@@ -1,35 +1,74 @@
-from tifffile import imwrite
+from tifffile import imwrite, memmap
 import numpy as np
-import pims
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import nd2
+import numba
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
 import time
 import sys
 import psutil
 import os
-
-# Function to max project a single FOV
-def process_fov(fov, m, all_fovs_array):
-    all_fovs_array[m] = np.max(fov, axis=1)  # Max projection across the Z-axis
+from projection import maxproj_z, channel_display_range, scale_to_uint8
+
+# ND2 file and its per-FOV frame indices, opened once per worker process by init_worker
+nd2_file = None
+fov_frames = None
+
+# Sequence indices of the frames of each FOV (the first time point only), so that fov_frames[m][z] is FOV m at Z plane z
+def frames_by_fov(f):
+    fov_frames = [[None] * f.sizes.get('Z', 1) for _ in range(f.sizes.get('P', 1))]
+    for index, coords in enumerate(f.loop_indices):
+        if coords.get('T', 0) == 0:
+            fov_frames[coords.get('P', 0)][coords.get('Z', 0)] = index
+    return fov_frames
+
+# Open the ND2 file once in each worker process and keep Numba to one thread per process
+def init_worker(in_filename):
+    global nd2_file, fov_frames
+    numba.set_num_threads(1)  # The pool already runs one process per core
+    nd2_file = nd2.ND2File(in_filename)
+    fov_frames = frames_by_fov(nd2_file)
+
+# Function to read and max project a single FOV in a worker process
+def process_fov(m):
+    channels, height, width = nd2_file.sizes.get('C', 1), nd2_file.sizes['Y'], nd2_file.sizes['X']
+    fov = np.empty((channels, len(fov_frames[m]), height, width), dtype=nd2_file.dtype)
+    for z, index in enumerate(fov_frames[m]):
+        fov[:, z] = nd2_file.read_frame(index)  # One (C, Y, X) frame per Z plane, decoded in C by nd2
+    max_proj = np.empty((channels, height, width), dtype=np.uint16)
+    maxproj_z(fov, max_proj)  # Max projection across the Z-axis
+    return m, max_proj
+
+# Lossless TIFF compressions accepted for the output, and which of them take a compression level (set to 1 for write speed)
+COMPRESSIONS = {'zstd', 'zlib', 'deflate', 'adobe_deflate', 'lzma', 'lzw', 'packbits'}
+LEVEL_COMPRESSIONS = {'zstd', 'zlib', 'deflate', 'adobe_deflate', 'lzma'}
 
 # Main function with input and output filenames as arguments
-def main(in_filename, out_filename, num_fovs=None):
+# compression, e.g. 'zstd' or 'zlib', writes a tiled, compressed OME-TIFF instead of an uncompressed one.
+# out_dtype=np.uint8 scales every FOV to 8 bits using the per-channel 1-99.5 percentile range of the first FOV.
+def main(in_filename, out_filename, num_fovs=None, compression=None, out_dtype=np.uint16):
+    # Check the compression before any FOV is processed
+    if compression and compression.lower() not in COMPRESSIONS:
+        raise ValueError(f"compression must be one of {sorted(COMPRESSIONS)}, got {compression!r}")
+
+    # Only 16-bit output or 8-bit display-scaled output are supported; check before the output file is created
+    if np.dtype(out_dtype) not in (np.uint16, np.uint8):
+        raise ValueError(f"out_dtype must be uint16 or uint8, got {np.dtype(out_dtype)}")
+
     # Start total duration timer
     start_total = time.time()
 
-    # Open pims with ND2 file to get image dimensions
-    with pims.open(in_filename) as images:
+    # Open ND2 file to get image dimensions, closed again before the workers open their own readers
+    with nd2.ND2File(in_filename) as f:
         # Start timer for reading dimensions
         start_reading = time.time()
 
         # Get image dimensions
-        channels = images.sizes['c']
-        width = images.sizes['x']
-        height = images.sizes['y']
-        fovs = images.sizes['m']
-        zs = images.sizes['z']
-
-        images.iter_axes = 'm'
-        images.bundle_axes = 'czyx'
+        channels = f.sizes.get('C', 1)
+        width = f.sizes['X']
+        height = f.sizes['Y']
+        fovs = f.sizes.get('P', 1)
+        zs = f.sizes.get('Z', 1)
 
         # Limit FOVs if specified
         if num_fovs:
@@ -39,51 +78,77 @@ def main(in_filename, out_filename, num_fovs=None):
         duration_reading = time.time() - start_reading
         print(f"Time to read dimensions: {duration_reading:.2f} seconds")
 
-        # Preallocate the results array to hold the selected FOVs: shape (fovs, channels, height, width)
-        all_fovs_array = np.zeros((fovs, channels, height, width), dtype=np.uint16)
-
-        # Calculate memory-per-thread, set max_workers based on memory and CPU count
-        overhead = 1.5
-        data_type_size = 2  # bytes for uint16
-        memory_per_thread = height * width * channels * zs * data_type_size * overhead  # in bytes
-        print('Estimated memory per thread ', memory_per_thread / 1e9, ' GB')
-        available_memory = psutil.virtual_memory().available
-        print('Available Memory', available_memory / 1e9, 'GB')
-        optimal_workers = min(available_memory // memory_per_thread, os.cpu_count())
-        print('Optimal Workers', optimal_workers)
-        max_workers = max(1, optimal_workers)  # Ensure at least 1 worker
-
-        # Start timer for processing FOVs
-        start_processing = time.time()
-
-        # Loop through FOVs in batches
-        batch_size = max_workers
-        for start_index in range(0, fovs, batch_size):
-            start_batch = time.time()
-            end_index = min(start_index + batch_size, fovs)
-            batch = [images[m] for m in range(start_index, end_index)]
-
-            duration_load = time.time() - start_batch
-            print(f"Time to process FOVs {start_index} to {end_index}: {duration_load:.2f} seconds")
-
-            # Process the current batch in parallel
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                futures = {executor.submit(process_fov, batch[i], start_index + i, all_fovs_array) for i in range(len(batch))}
-
-                # Wait for all futures in the batch to complete
-                for future in as_completed(futures):
-                    future.result()
-            duration_batch = time.time() - start_batch
-            print(f"Time to process FOVs: {duration_batch:.2f} seconds")
-        # Stop timer for processing FOVs
-        duration_processing = time.time() - start_processing
-        print(f"Time to process FOVs: {duration_processing:.2f} seconds")
+    # Preallocate the results array as a memory-mapped OME-TIFF, so each FOV is stored straight into the output file: shape (fovs, channels, height, width)
+    # A compressed output can't be memory-mapped, so project into an uncompressed scratch file next to it instead
+    memmap_filename = out_filename + '.tmp.ome.tif' if compression else out_filename
+    all_fovs_array = memmap(memmap_filename, shape=(fovs, channels, height, width), dtype=out_dtype, ome=True, photometric='minisblack', metadata={'axes': 'TCYX'})
+
+    # Calculate memory-per-process, set max_workers based on memory and CPU count
+    overhead = 1.5
+    data_type_size = 2  # bytes for uint16
+    memory_per_process = height * width * channels * zs * data_type_size * overhead  # in bytes, one FOV held by each worker process
+    print('Estimated memory per process ', memory_per_process / 1e9, ' GB')
+    available_memory = psutil.virtual_memory().available
+    print('Available Memory', available_memory / 1e9, 'GB')
+    optimal_workers = min(available_memory // memory_per_process, os.cpu_count())
+    print('Optimal Workers', optimal_workers)
+    max_workers = max(1, int(optimal_workers))  # Ensure at least 1 worker
+
+    # Start timer for processing FOVs
+    start_processing = time.time()
+
+    # Worker processes read and project FOVs themselves, each with its own reader, and send back the (C, Y, X) projection.
+    # Spawned rather than forked so the workers don't inherit the parent's threading state.
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(in_filename,)) as executor:
+        # Submit every FOV up front so a free worker starts the next FOV without waiting on a batch boundary.
+        # Each worker process holds only the FOV it is reading, and only (C, Y, X) results come back.
+        first_future = executor.submit(process_fov, 0)
+        futures = {first_future} | {executor.submit(process_fov, m) for m in range(1, fovs)}
+
+        # For 8-bit output, take the display range from the first FOV while the other FOVs keep processing
+        quantize = np.dtype(out_dtype) == np.uint8
+        if quantize:
+            p_lo, p_hi = channel_display_range(first_future.result()[1])
+        del first_future
+
+        # Store the results as they complete, dropping each future once stored so finished projections don't pile up in memory
+        for count, future in enumerate(as_completed(futures), start=1):
+            futures.remove(future)
+            m, max_proj = future.result()
+            if quantize:
+                scale_to_uint8(max_proj, p_lo, p_hi, all_fovs_array[m])
+            else:
+                all_fovs_array[m] = max_proj
+            if count % max_workers == 0 or count == fovs:
+                duration_so_far = time.time() - start_processing
+                print(f"Time to process {count} of {fovs} FOVs: {duration_so_far:.2f} seconds")
+    # Stop timer for processing FOVs
+    duration_processing = time.time() - start_processing
+    print(f"Time to process FOVs: {duration_processing:.2f} seconds")
 
     # Start timer for writing TIFF
     start_writing = time.time()
 
-    # Open TIFF writer with OME-TIFF format
-    imwrite(out_filename, all_fovs_array, ome=True, photometric='minisblack', metadata={'axes': 'TCYX'})
+    if compression:
+        # Write the tiled, compressed OME-TIFF, compressing tiles in parallel across CPU cores, then remove the scratch file.
+        # A failed write leaves neither the scratch file nor a partial output behind.
+        compressionargs = {'level': 1} if compression.lower() in LEVEL_COMPRESSIONS else None
+        try:
+            imwrite(out_filename, all_fovs_array, ome=True, photometric='minisblack', metadata={'axes': 'TCYX'},
+                    tile=(1024, 1024), compression=compression, compressionargs=compressionargs, maxworkers=os.cpu_count(),
+                    bigtiff=(all_fovs_array.nbytes > 2**31))
+        except BaseException:
+            if os.path.exists(out_filename):
+                os.remove(out_filename)
+            raise
+        finally:
+            del all_fovs_array
+            os.remove(memmap_filename)
+    else:
+        # Flush the memory-mapped OME-TIFF to disk
+        all_fovs_array.flush()
+        del all_fovs_array
 
     # Stop timer for writing TIFF
     duration_writing = time.time() - start_writing
@@ -98,4 +163,6 @@ if __name__ == "__main__":
     in_filename = sys.argv[1] if len(sys.argv) > 1 else '/mnt2/nepenthes/Chris/acx_tangential_starmap/yc19lbp2/round9.nd2'
     out_filename = sys.argv[2] if len(sys.argv) > 2 else '/home/kebschulllab/max_proj/max_round9.ome.tif'
     num_fovs = int(sys.argv[3]) if len(sys.argv) > 3 else None  # Optional number of FOVs to process
-    main(in_filename, out_filename, num_fovs)
+    compression = sys.argv[4] if len(sys.argv) > 4 and sys.argv[4] != 'none' else None  # Optional compression, e.g. zstd, or none
+    out_dtype = np.dtype(sys.argv[5]) if len(sys.argv) > 5 else np.uint16  # Optional output dtype, uint16 or uint8
+    main(in_filename, out_filename, num_fovs, compression, out_dtype)
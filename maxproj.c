@@ -0,0 +1,54 @@
+// SIMD + OpenMP max projection across Z for (C, Z, Y, X) uint16 FOVs, loaded from projection.py with ctypes.
+// Build with: gcc -O3 -march=native -fopenmp -shared -fPIC maxproj.c -o libmaxproj.so
+#include <stddef.h>
+#include <stdint.h>
+#include <string.h>
+#include <immintrin.h>
+
+// Pixels per work item; the running max for a block (8 KB) stays in L1 while every Z plane streams past it
+#define BLOCK 4096
+
+static void max_block(uint16_t *dst, const uint16_t *src, size_t n)
+{
+    size_t i = 0;
+#if defined(__AVX512BW__)
+    for (; i + 32 <= n; i += 32) {
+        __m512i acc = _mm512_loadu_si512((const void *)(dst + i));
+        acc = _mm512_max_epu16(acc, _mm512_loadu_si512((const void *)(src + i)));
+        _mm512_storeu_si512((void *)(dst + i), acc);
+    }
+#elif defined(__AVX2__)
+    for (; i + 16 <= n; i += 16) {
+        __m256i acc = _mm256_loadu_si256((const __m256i *)(dst + i));
+        acc = _mm256_max_epu16(acc, _mm256_loadu_si256((const __m256i *)(src + i)));
+        _mm256_storeu_si256((__m256i *)(dst + i), acc);
+    }
+#endif
+    for (; i < n; i++) {
+        if (src[i] > dst[i]) {
+            dst[i] = src[i];
+        }
+    }
+}
+
+// in is a C-contiguous (C, Z, YX) array and out a C-contiguous (C, YX) array
+void maxproj_u16(const uint16_t *in, uint16_t *out, size_t C, size_t Z, size_t YX, int n_threads)
+{
+    long n_blocks = (long)((YX + BLOCK - 1) / BLOCK);
+
+    for (size_t c = 0; c < C; c++) {
+        const uint16_t *src = in + c * Z * YX;
+        uint16_t *dst = out + c * YX;
+
+        #pragma omp parallel for num_threads(n_threads) schedule(static)
+        for (long b = 0; b < n_blocks; b++) {
+            size_t start = (size_t)b * BLOCK;
+            size_t n = YX - start < BLOCK ? YX - start : BLOCK;
+
+            memcpy(dst + start, src + start, n * sizeof(uint16_t));
+            for (size_t z = 1; z < Z; z++) {
+                max_block(dst + start, src + z * YX + start, n);
+            }
+        }
+    }
+}
@@ -0,0 +1,84 @@
+from tifffile import memmap
+import numpy as np
+import nd2
+import zarr
+import dask
+import dask.array as da
+import time
+import sys
+import os
+import psutil
+
+# Convert an ND2 file once into a Zarr array of shape (fovs, channels, zs, height, width).
+# Each (FOV, channel, Z) plane is its own Blosc-zstd chunk, so later runs read it in parallel without decoding the ND2 again.
+def nd2_to_zarr(in_filename, zarr_path):
+    with nd2.ND2File(in_filename) as f:
+        channels = f.sizes.get('C', 1)
+        width = f.sizes['X']
+        height = f.sizes['Y']
+        fovs = f.sizes.get('P', 1)
+        zs = f.sizes.get('Z', 1)
+
+        z_arr = zarr.create_array(store=zarr_path, shape=(fovs, channels, zs, height, width), chunks=(1, 1, 1, height, width),
+                                  dtype=f.dtype, compressors=zarr.codecs.BloscCodec(cname='zstd', clevel=1, shuffle='bitshuffle'),
+                                  overwrite=True)
+
+        # Copy every frame of the first time point to its FOV and Z plane, one (C, Y, X) frame at a time
+        for index, coords in enumerate(f.loop_indices):
+            if coords.get('T', 0) == 0:
+                z_arr[coords.get('P', 0), :, coords.get('Z', 0)] = f.read_frame(index)
+
+# Max project the Zarr array across Z into a memory-mapped TCYX OME-TIFF, one Dask task per FOV and channel
+def max_project_zarr(zarr_path, out_filename, num_fovs=None):
+    darr = da.from_zarr(zarr_path, chunks=(1, 1, -1, -1, -1))
+
+    # Limit FOVs if specified
+    if num_fovs:
+        darr = darr[:num_fovs]
+
+    # Each task holds one (Z, Y, X) stack, so cap the number of Dask threads by available memory as well as CPU count
+    overhead = 1.5
+    memory_per_task = darr.shape[2] * darr.shape[3] * darr.shape[4] * darr.dtype.itemsize * overhead  # in bytes
+    available_memory = psutil.virtual_memory().available
+    max_workers = max(1, int(min(available_memory // memory_per_task, os.cpu_count())))
+    print('Dask workers', max_workers)
+
+    # Axes are already (FOV, C, Z, Y, X), so reducing Z gives the TCYX output layout without any transpose
+    projected = darr.max(axis=2).astype(np.uint16)
+    all_fovs_array = memmap(out_filename, shape=projected.shape, dtype=np.uint16, ome=True, photometric='minisblack', metadata={'axes': 'TCYX'})
+    with dask.config.set(scheduler='threads', num_workers=max_workers):
+        da.store(projected, all_fovs_array, lock=False)
+    all_fovs_array.flush()
+    del all_fovs_array
+
+# Main function: convert the ND2 to Zarr on the first run, then max project from the Zarr array
+def main(in_filename, zarr_path, out_filename, num_fovs=None):
+    # Start total duration timer
+    start_total = time.time()
+
+    if not os.path.exists(zarr_path):
+        # Start timer for converting to Zarr
+        start_converting = time.time()
+        # Convert under a temporary name so an interrupted conversion is not mistaken for a finished one
+        nd2_to_zarr(in_filename, zarr_path + '.partial')
+        os.rename(zarr_path + '.partial', zarr_path)
+        duration_converting = time.time() - start_converting
+        print(f"Time to convert ND2 to Zarr: {duration_converting:.2f} seconds")
+
+    # Start timer for processing FOVs
+    start_processing = time.time()
+    max_project_zarr(zarr_path, out_filename, num_fovs)
+    duration_processing = time.time() - start_processing
+    print(f"Time to process FOVs: {duration_processing:.2f} seconds")
+
+    # Stop total duration timer
+    total_duration = time.time() - start_total
+    print(f"Total time: {total_duration:.2f} seconds")
+
+# Run main function with command-line arguments or specify filenames here
+if __name__ == "__main__":
+    in_filename = sys.argv[1] if len(sys.argv) > 1 else '/path/image.nd2'
+    zarr_path = sys.argv[2] if len(sys.argv) > 2 else '/path/image.zarr'
+    out_filename = sys.argv[3] if len(sys.argv) > 3 else '/path/max_image.ome.tif'
+    num_fovs = int(sys.argv[4]) if len(sys.argv) > 4 else None  # Optional number of FOVs to process
+    main(in_filename, zarr_path, out_filename, num_fovs)
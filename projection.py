@@ -0,0 +1,57 @@
+import ctypes
+import os
+import numpy as np
+import numba as nb
+from numba import prange
+
+# Max project a single (C, Z, Y, X) uint16 FOV across Z into a preallocated (C, Y, X) uint16 array.
+# Written as plain loops with X innermost so the stride-1 row max vectorizes, and rows run in parallel.
+# Releases the GIL so it can overlap with FOV reads on other threads, but launch it from one thread at a time:
+# Numba's default workqueue threading layer does not support concurrent parallel launches.
+@nb.njit(nb.void(nb.uint16[:, :, :, ::1], nb.uint16[:, :, ::1]), parallel=True, nogil=True, fastmath=True, boundscheck=False, cache=True)
+def _maxproj_z_u16(fov, out):
+    C, Z, Y, X = fov.shape
+    for c in range(C):
+        for y in prange(Y):
+            for x in range(X):
+                out[c, y, x] = fov[c, 0, y, x]
+            for z in range(1, Z):
+                for x in range(X):
+                    v = fov[c, z, y, x]
+                    if v > out[c, y, x]:
+                        out[c, y, x] = v
+
+# Optional AVX2/AVX-512 + OpenMP kernel from maxproj.c, used instead of the Numba kernel when it has been built
+try:
+    _libmaxproj = ctypes.CDLL(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libmaxproj.so'))
+except OSError:
+    _libmaxproj = None
+else:
+    _libmaxproj.maxproj_u16.restype = None
+    _libmaxproj.maxproj_u16.argtypes = [
+        np.ctypeslib.ndpointer(dtype=np.uint16, flags='C_CONTIGUOUS'),
+        np.ctypeslib.ndpointer(dtype=np.uint16, flags='C_CONTIGUOUS'),
+        ctypes.c_size_t, ctypes.c_size_t, ctypes.c_size_t, ctypes.c_int,
+    ]
+
+# Max project a (C, Z, Y, X) FOV across Z into out, a C-contiguous (C, Y, X) uint16 array such as all_fovs_array[m].
+# uint16 FOVs go through the C kernel if built, else the jitted kernel, both using Numba's thread count;
+# any other dtype falls back to np.max and is cast to uint16 on assignment.
+def maxproj_z(fov, out):
+    if fov.dtype == np.uint16 and _libmaxproj is not None:
+        C, Z, Y, X = fov.shape
+        _libmaxproj.maxproj_u16(np.ascontiguousarray(fov), out, C, Z, Y * X, nb.get_num_threads())
+    elif fov.dtype == np.uint16:
+        _maxproj_z_u16(np.ascontiguousarray(fov), out)
+    else:
+        out[...] = np.max(fov, axis=1)
+
+# Per-channel display range of a projected (C, Y, X) FOV, as (C, 1, 1) arrays of its lower and upper percentiles
+def channel_display_range(max_proj, lower=1, upper=99.5):
+    p_lo, p_hi = np.percentile(max_proj, [lower, upper], axis=(1, 2), keepdims=True)
+    return p_lo, p_hi
+
+# Scale a projected (C, Y, X) FOV from its display range (p_lo, p_hi) to 0-255, clipping, and store it in the uint8 array out
+def scale_to_uint8(max_proj, p_lo, p_hi, out):
+    scale = 255.0 / np.maximum(p_hi - p_lo, 1)
+    out[...] = np.clip((max_proj - p_lo) * scale, 0, 255)